@@ -7,13 +7,37 @@
 """Syntactic conversion of predicate-logic formulas to not use functions and
 equality."""
 
-from typing import List
-
-from src.logic_utils import is_z_and_number
-
-from src.predicates.semantics import *
-
-
+import sys
+from functools import lru_cache
+from typing import AbstractSet, Dict, List, Set, Tuple, Union
+
+from src.logic_utils import fresh_variable_name_generator, is_z_and_number
+
+from src.predicates.semantics import Model, T
+from src.predicates.syntax import (
+    Formula,
+    Term,
+    is_binary,
+    is_equality,
+    is_function,
+    is_quantifier,
+    is_relation,
+    is_unary,
+)
+
+#: The relation name that stands in for equality.
+_SAME = sys.intern("SAME")
+
+#: Formulas that ensure that the interpretation of ``'SAME'`` is reflexive,
+#: symmetric, and transitive.
+_SAME_EQUIVALENCE_AXIOMS = (
+    Formula.parse("Ax[SAME(x,x)]"),
+    Formula.parse("Ax[Ay[(SAME(x,y)->SAME(y,x))]]"),
+    Formula.parse("Ax[Ay[Az[((SAME(x,y)&SAME(y,z))->SAME(x,z))]]]"),
+)
+
+
+@lru_cache(maxsize=1024)  # Cache the return value of function_name_to_relation_name
 def function_name_to_relation_name(function: str) -> str:
     """Converts the given function name to a canonically corresponding relation
     name.
@@ -26,9 +50,10 @@ def function_name_to_relation_name(function: str) -> str:
         its first letter is capitalized.
     """
     assert is_function(function)
-    return function[0].upper() + function[1:]
+    return sys.intern(function[0].upper() + function[1:])
 
 
+@lru_cache(maxsize=1024)  # Cache the return value of relation_name_to_function_name
 def relation_name_to_function_name(relation: str) -> str:
     """Converts the given relation name to a canonically corresponding function
     name.
@@ -42,7 +67,7 @@ def relation_name_to_function_name(relation: str) -> str:
         relation name.
     """
     assert is_relation(relation)
-    return relation[0].lower() + relation[1:]
+    return sys.intern(relation[0].lower() + relation[1:])
 
 
 def replace_functions_with_relations_in_model(model: Model[T]) -> Model[T]:
@@ -67,6 +92,19 @@ def replace_functions_with_relations_in_model(model: Model[T]) -> Model[T]:
     for function in model.function_interpretations:
         assert function_name_to_relation_name(function) not in model.relation_interpretations
     # Task 8.1
+    return Model(
+        model.universe,
+        model.constant_interpretations,
+        {
+            **model.relation_interpretations,
+            **{
+                function_name_to_relation_name(function): frozenset(
+                    (value, *arguments) for arguments, value in interpretation.items()
+                )
+                for function, interpretation in model.function_interpretations.items()
+            },
+        },
+    )
 
 
 def replace_relations_with_functions_in_model(
@@ -89,11 +127,85 @@ def replace_relations_with_functions_in_model(
         is the given model, or ``None`` if no such model exists.
     """
     assert len(model.function_interpretations) == 0
+    replacements = []
     for function in original_functions:
         assert is_function(function)
         assert function not in model.function_interpretations
-        assert function_name_to_relation_name(function) in model.relation_interpretations
+        relation = function_name_to_relation_name(function)
+        assert relation in model.relation_interpretations
+        replacements.append((function, relation, model.relation_interpretations[relation]))
     # Task 8.2
+    function_interpretations = {}
+    for function, relation, interpretation in replacements:
+        arity = model.relation_arities[relation] - 1
+        if arity < 1:
+            return None
+        function_interpretation = {}
+        for value, *arguments in interpretation:
+            arguments = tuple(arguments)
+            if arguments in function_interpretation:
+                return None
+            function_interpretation[arguments] = value
+        if len(function_interpretation) != len(model.universe) ** arity:
+            return None
+        function_interpretations[function] = function_interpretation
+    replaced_relations = {relation for function, relation, interpretation in replacements}
+    return Model(
+        model.universe,
+        model.constant_interpretations,
+        {
+            relation: interpretation
+            for relation, interpretation in model.relation_interpretations.items()
+            if relation not in replaced_relations
+        },
+        function_interpretations,
+    )
+
+
+def _compile_term_into(term: Term,
+                       memo: Dict[Tuple[str, Tuple[Term, ...]], Term],
+                       steps: List[Formula]) -> Term:
+    """Syntactically compiles the given term into single-function invocation
+    steps, reusing the steps of invocations that were already compiled.
+
+    Parameters:
+        term: term to compile, whose root is a function invocation.
+        memo: mapping from pairs of a function name and a tuple of compiled
+            arguments (constants, variables, or left-hand-side variables of
+            earlier steps) to the left-hand-side variable of the step that
+            invokes that function on those arguments, which is updated with
+            every new step.
+        steps: list to which the new steps are appended, in the order
+            specified by `_compile_term`.
+
+    Returns:
+        The left-hand-side variable of the step that computes the given term.
+    """
+    # Iterative post-order walk: each stack entry holds a function-rooted term,
+    # an iterator over its arguments that are yet to be visited, and the
+    # already compiled arguments (constants, variables, or fresh variables of
+    # earlier steps). An invocation is looked up in the memo only once its
+    # arguments are compiled, so each key is shallow and cheap to hash.
+    stack = [(term, iter(term.arguments), [])]
+    while True:
+        current, remaining, arguments = stack[-1]
+        for argument in remaining:
+            if not is_function(argument.root):
+                arguments.append(argument)
+            else:
+                stack.append((argument, iter(argument.arguments), []))
+                break
+        else:
+            stack.pop()
+            key = (current.root, tuple(arguments))
+            variable = memo.get(key)
+            if variable is None:
+                variable = Term(next(fresh_variable_name_generator))
+                steps.append(Formula("=", [variable, Term(current.root, arguments)]))
+                memo[key] = variable
+            if len(stack) == 0:
+                return variable
+            stack[-1][2].append(variable)
 
 
 def _compile_term(term: Term) -> List[Formula]:
@@ -118,9 +230,13 @@ def _compile_term(term: Term) -> List[Formula]:
         term.
     """
     assert is_function(term.root)
-    for variable in term.variables():
-        assert not is_z_and_number(variable)
+    if __debug__:
+        for variable in term.variables():
+            assert not is_z_and_number(variable)
     # Task 8.3
+    steps: List[Formula] = []
+    _compile_term_into(term, {}, steps)
+    return steps
 
 
 def replace_functions_with_relations_in_formula(formula: Formula) -> Formula:
@@ -140,17 +256,100 @@ def replace_functions_with_relations_in_formula(formula: Formula) -> Formula:
         only if the returned formula holds in
         `replace_function_with_relations_in_model`\ ``(``\ `model`\ ``)``.
     """
-    assert (
-        len(
-            {function_name_to_relation_name(function) for function, arity in formula.functions()}.intersection(
-                {relation for relation, arity in formula.relations()}
-            )
+    if __debug__:
+        function_relations = {function_name_to_relation_name(function) for function, arity in formula.functions()}
+        for relation, arity in formula.relations():
+            assert relation not in function_relations
+        for variable in formula.variables():
+            assert not is_z_and_number(variable)
+    # Task 8.4
+    return _replace_functions_with_relations_in_formula(formula)
+
+
+def _replace_functions_with_relations_in_formula(formula: Formula) -> Formula:
+    """Syntactically converts the given formula to a formula that does not
+    contain any function invocations, as specified by
+    `replace_functions_with_relations_in_formula`, without checking its
+    preconditions.
+
+    Parameters:
+        formula: formula to convert, which satisfies the preconditions of
+            `replace_functions_with_relations_in_formula`.
+
+    Returns:
+        The converted formula.
+    """
+    if is_unary(formula.root):
+        return Formula(formula.root, _replace_functions_with_relations_in_formula(formula.first))
+    if is_binary(formula.root):
+        return Formula(
+            formula.root,
+            _replace_functions_with_relations_in_formula(formula.first),
+            _replace_functions_with_relations_in_formula(formula.second),
+        )
+    if is_quantifier(formula.root):
+        return Formula(
+            formula.root,
+            formula.variable,
+            _replace_functions_with_relations_in_formula(formula.statement),
         )
-        == 0
+    # The fresh variable names are existentially quantified right around this
+    # relation invocation or equality, so compiled subterms can only be shared
+    # between its own arguments.
+    memo: Dict[Tuple[str, Tuple[Term, ...]], Term] = {}
+    steps: List[Formula] = []
+    arguments = []
+    for argument in formula.arguments:
+        if is_function(argument.root):
+            arguments.append(_compile_term_into(argument, memo, steps))
+        else:
+            arguments.append(argument)
+    new_formula = Formula(formula.root, arguments)
+    for step in reversed(steps):
+        variable, invocation = step.arguments
+        relation = Formula(
+            function_name_to_relation_name(invocation.root),
+            [variable, *invocation.arguments],
+        )
+        new_formula = Formula("E", variable.root, Formula("&", relation, new_formula))
+    return new_formula
+
+
+def _function_axiom(function: str, arity: int) -> Formula:
+    """Computes a formula that ensures that the interpretation of the relation
+    name that canonically corresponds to the given function name is the graph
+    of a function.
+
+    Parameters:
+        function: function name.
+        arity: arity of the given function name.
+
+    Returns:
+        A formula stating, for all ``x1``,...,\ ``x``\ `arity`, that there
+        exists exactly one ``y`` such that the canonically corresponding
+        relation name holds for ``(y,x1,``...\ ``,x``\ `arity`\ ``)``.
+    """
+    relation = function_name_to_relation_name(function)
+    xs = [Term("x" + str(i)) for i in range(1, arity + 1)]
+    y, y1, y2 = Term("y"), Term("y1"), Term("y2")
+    existence = Formula("E", y.root, Formula(relation, [y, *xs]))
+    uniqueness = Formula(
+        "A",
+        y1.root,
+        Formula(
+            "A",
+            y2.root,
+            Formula(
+                "->",
+                Formula("&", Formula(relation, [y1, *xs]), Formula(relation, [y2, *xs])),
+                Formula("=", [y1, y2]),
+            ),
+        ),
     )
-    for variable in formula.variables():
-        assert not is_z_and_number(variable)
-    # Task 8.4
+    axiom = Formula("&", existence, uniqueness)
+    for x in reversed(xs):
+        axiom = Formula("A", x.root, axiom)
+    return axiom
 
 
 def replace_functions_with_relations_in_formulas(
@@ -185,21 +384,101 @@ def replace_functions_with_relations_in_formulas(
            where `original_functions` are all the function names in the given
            formulas, is a model and the given formulas hold in it.
     """
-    assert (
-        len(
-            set.union(
-                *[
-                    {function_name_to_relation_name(function) for function, arity in formula.functions()}
-                    for formula in formulas
-                ]
-            ).intersection(set.union(*[{relation for relation, arity in formula.relations()} for formula in formulas]))
-        )
-        == 0
-    )
-    for formula in formulas:
-        for variable in formula.variables():
-            assert not is_z_and_number(variable)
+    functions = {function for formula in formulas for function in formula.functions()}
+    if __debug__:
+        function_relations = {function_name_to_relation_name(function) for function, arity in functions}
+        for formula in formulas:
+            for relation, arity in formula.relations():
+                assert relation not in function_relations
+            for variable in formula.variables():
+                assert not is_z_and_number(variable)
     # Task 8.5
+    new_formulas = [_replace_functions_with_relations_in_formula(formula) for formula in formulas]
+    new_formulas.extend(_function_axiom(function, arity) for function, arity in functions)
+    return set(new_formulas)
+
+
+def _replace_equality_with_SAME_in_formula(formula: Formula, memo: Dict[int, Formula]) -> Formula:
+    """Syntactically replaces each equality in the given formula with a
+    matching invocation of the relation name ``'SAME'``.
+
+    Parameters:
+        formula: formula to convert.
+        memo: mapping from ids of already converted formulas to their converted
+            formulas, which is updated with the subformulas of the given
+            formula. The formulas whose ids it holds must still be alive, so it
+            should not outlive a single conversion.
+
+    Returns:
+        The converted formula, which is the given formula itself if it contains
+        no equalities.
+    """
+    key = id(formula)
+    result = memo.get(key)
+    if result is not None:
+        return result
+    if is_equality(formula.root):
+        result = Formula(_SAME, formula.arguments)
+    elif is_relation(formula.root):
+        result = formula
+    elif is_unary(formula.root):
+        first = _replace_equality_with_SAME_in_formula(formula.first, memo)
+        result = formula if first is formula.first else Formula(formula.root, first)
+    elif is_binary(formula.root):
+        first = _replace_equality_with_SAME_in_formula(formula.first, memo)
+        second = _replace_equality_with_SAME_in_formula(formula.second, memo)
+        if first is formula.first and second is formula.second:
+            result = formula
+        else:
+            result = Formula(formula.root, first, second)
+    else:
+        statement = _replace_equality_with_SAME_in_formula(formula.statement, memo)
+        result = formula if statement is formula.statement else Formula(formula.root, formula.variable, statement)
+    memo[key] = result
+    return result
+
+
+@lru_cache(maxsize=100)  # Cache the return value of _congruence_template
+def _congruence_template(arity: int) -> Tuple[Tuple[Term, ...], Tuple[Term, ...], Formula]:
+    """Computes the relation-independent parts of a formula that ensures that
+    the interpretation of a relation name of the given arity respects the
+    interpretation of the relation name ``'SAME'``.
+
+    Parameters:
+        arity: positive arity of the relation name.
+
+    Returns:
+        A triple of the variables ``x1``,...,\ ``x``\ `arity`, the variables
+        ``y1``,...,\ ``y``\ `arity`, and the conjunction of
+        ``'SAME(x``\ `i`\ ``,y``\ `i`\ ``)'`` over all of them.
+    """
+    xs = tuple(Term("x" + str(i)) for i in range(1, arity + 1))
+    ys = tuple(Term("y" + str(i)) for i in range(1, arity + 1))
+    conjunction = Formula(_SAME, [xs[0], ys[0]])
+    for x, y in zip(xs[1:], ys[1:]):
+        conjunction = Formula("&", conjunction, Formula(_SAME, [x, y]))
+    return xs, ys, conjunction
+
+
+def _congruence_axiom(relation: str, arity: int) -> Formula:
+    """Computes a formula that ensures that the interpretation of the given
+    relation name respects the interpretation of the relation name ``'SAME'``.
+
+    Parameters:
+        relation: relation name other than ``'SAME'``.
+        arity: positive arity of the given relation name.
+
+    Returns:
+        A formula stating, for all ``x1``,...,\ ``x``\ `arity` and
+        ``y1``,...,\ ``y``\ `arity` such that every
+        ``SAME(x``\ `i`\ ``,y``\ `i`\ ``)`` holds, that the given relation
+        name holds for the former only if it holds for the latter.
+    """
+    xs, ys, conjunction = _congruence_template(arity)
+    axiom = Formula("->", conjunction, Formula("->", Formula(relation, xs), Formula(relation, ys)))
+    for variable in reversed(xs + ys):
+        axiom = Formula("A", variable.root, axiom)
+    return axiom
 
 
 def replace_equality_with_SAME_in_formulas(
@@ -226,10 +505,20 @@ def replace_equality_with_SAME_in_formulas(
     Returns:
         The converted set of formulas.
     """
+    relations = set()
     for formula in formulas:
         assert len(formula.functions()) == 0
-        assert "SAME" not in {relation for relation, arity in formula.relations()}
+        formula_relations = formula.relations()
+        if __debug__:
+            for relation, arity in formula_relations:
+                assert relation != _SAME
+        relations.update(formula_relations)
     # Task 8.6
+    memo: Dict[int, Formula] = {}
+    new_formulas = {_replace_equality_with_SAME_in_formula(formula, memo) for formula in formulas}
+    new_formulas.update(_SAME_EQUIVALENCE_AXIOMS)
+    new_formulas.update(_congruence_axiom(relation, arity) for relation, arity in relations if arity > 0)
+    return new_formulas
 
 
 def add_SAME_as_equality_in_model(model: Model[T]) -> Model[T]:
@@ -246,8 +535,15 @@ def add_SAME_as_equality_in_model(model: Model[T]) -> Model[T]:
         ``(``\ `x`\ ``,``\ `x`\ ``)`` for every element `x` of the universe of
         the given model.
     """
-    assert "SAME" not in model.relation_interpretations
+    assert _SAME not in model.relation_interpretations
     # Task 8.7
+    same = frozenset((element, element) for element in model.universe)
+    return Model(
+        model.universe,
+        model.constant_interpretations,
+        {**model.relation_interpretations, _SAME: same},
+        model.function_interpretations,
+    )
 
 
 def make_equality_as_SAME_in_model(model: Model[T]) -> Model[T]:
@@ -270,6 +566,42 @@ def make_equality_as_SAME_in_model(model: Model[T]) -> Model[T]:
         the returned model corresponds to the equivalence classes of the
         interpretation of ``'SAME'`` in the given model.
     """
-    assert "SAME" in model.relation_interpretations and model.relation_arities["SAME"] == 2
+    assert _SAME in model.relation_interpretations and model.relation_arities[_SAME] == 2
     assert len(model.function_interpretations) == 0
     # Task 8.8
+    # Disjoint-set union over the universe, with path compression and union by
+    # rank; the root of each set represents its equivalence class.
+    parent = {element: element for element in model.universe}
+    rank = {element: 0 for element in model.universe}
+
+    def find(element: T) -> T:
+        root = element
+        while parent[root] != root:
+            root = parent[root]
+        while parent[element] != root:
+            parent[element], element = root, parent[element]
+        return root
+
+    for first, second in model.relation_interpretations[_SAME]:
+        # SAME is reflexive, so one pair per element needs no find at all.
+        if first == second:
+            continue
+        first, second = find(first), find(second)
+        if first == second:
+            continue
+        if rank[first] < rank[second]:
+            first, second = second, first
+        parent[second] = first
+        if rank[first] == rank[second]:
+            rank[first] += 1
+
+    representative = {element: find(element) for element in model.universe}
+    return Model(
+        set(representative.values()),
+        {constant: representative[value] for constant, value in model.constant_interpretations.items()},
+        {
+            relation: frozenset(tuple(representative[argument] for argument in arguments) for arguments in interpretation)
+            for relation, interpretation in model.relation_interpretations.items()
+            if relation != _SAME
+        },
+    )
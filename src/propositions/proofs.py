@@ -8,7 +8,7 @@
 
 from __future__ import annotations
 
-from typing import AbstractSet, FrozenSet, Sequence
+from typing import AbstractSet, Dict, FrozenSet, List, Sequence, Tuple
 
 from src.propositions.syntax import *
 
@@ -18,6 +18,118 @@ from src.propositions.syntax import *
 SpecializationMap = Mapping[str, Formula]
 
 
+def _substitute_variables_cached(formula: Formula,
+                                 specialization_map: SpecializationMap,
+                                 cache: Dict[int, Formula]) -> Formula:
+    """Substitutes in the given formula each variable name `v` that is a key in
+    `specialization_map` with the formula `specialization_map[v]`, reusing
+    previously computed substitutions of the same subformula objects.
+
+    Parameters:
+        formula: formula in which to substitute.
+        specialization_map: mapping defining the substitution to be performed.
+        cache: mapping from ids of already substituted formulas to their
+            substitution results under `specialization_map`, which is updated
+            with the subformulas of the given formula. The formulas whose ids
+            it holds must still be alive, so it should not outlive a single
+            computation.
+
+    Returns:
+        The resulting formula. A subformula object that is substituted more than
+        once using the same cache results in the same formula object.
+    """
+    key = id(formula)
+    result = cache.get(key)
+    if result is not None:
+        return result
+    root = formula.root
+    tag = root[0]
+    if 'p' <= tag <= 'z':
+        result = specialization_map.get(root, formula)
+    elif tag == '~':
+        result = Formula(root, _substitute_variables_cached(formula.first, specialization_map, cache))
+    elif tag == 'T' or tag == 'F':
+        result = formula
+    else:
+        result = Formula(root,
+                         _substitute_variables_cached(formula.first, specialization_map, cache),
+                         _substitute_variables_cached(formula.second, specialization_map, cache))
+    cache[key] = result
+    return result
+
+
+def _merge_into(accumulator: Dict[str, Formula],
+                specialization_map: SpecializationMap) -> bool:
+    """Merges the given specialization map into the given accumulator while
+    checking their consistency.
+
+    Parameters:
+        accumulator: mapping to extend in place.
+        specialization_map: mapping to merge into `accumulator`.
+
+    Returns:
+        ``True`` if no key appears in both given maps with different values,
+        ``False`` otherwise (in which case `accumulator` may have been
+        partially extended).
+    """
+    for variable, formula in specialization_map.items():
+        value = accumulator.get(variable)
+        if value is None:
+            accumulator[variable] = formula
+        elif value is not formula and value != formula:
+            return False
+    return True
+
+
+def _extend_specialization_map(general: Formula, specialization: Formula,
+                               specialization_map: Dict[str, Formula],
+                               visited: Set[Tuple[int, int]]) -> bool:
+    """Extends the given specialization map with the minimal (key, value) pairs
+    by which the given formula specializes to the given specialization.
+
+    Parameters:
+        general: non-specialized formula for which to extend the map.
+        specialization: specialization for which to extend the map.
+        specialization_map: mapping to extend in place.
+        visited: ids of the pairs of a general formula and of a specialization
+            that were already matched into `specialization_map`, which is
+            updated with every pair of corresponding subformulas. The formulas
+            of all of its pairs must still be alive, so it should not outlive a
+            single computation.
+
+    Returns:
+        ``True`` if `specialization` is a specialization of `general` that is
+        consistent with the given map, ``False`` otherwise (in which case the
+        map may have been partially extended).
+    """
+    # Обходим пары подформул явным стеком вместо рекурсии
+    stack = [(general, specialization)]
+    while stack:
+        general, specialization = stack.pop()
+        key = (id(general), id(specialization))
+        if key in visited:
+            continue
+        visited.add(key)
+        root = general.root
+        # Вид корня определяется по первому символу: переменные начинаются
+        # с 'p'..'z', константы - это 'T' и 'F', остальное - операторы
+        tag = root[0]
+        if 'p' <= tag <= 'z':
+            value = specialization_map.get(root)
+            if value is None:
+                specialization_map[root] = specialization
+            elif value is not specialization and value != specialization:
+                return False
+        elif root != specialization.root:
+            return False
+        elif tag == '~':
+            stack.append((general.first, specialization.first))
+        elif tag != 'T' and tag != 'F':
+            stack.append((general.second, specialization.second))
+            stack.append((general.first, specialization.first))
+    return True
+
+
 @frozen
 class InferenceRule:
     """An immutable inference rule in Propositional Logic, comprised of zero
@@ -62,7 +174,11 @@ class InferenceRule:
             ``True`` if the given object is an `InferenceRule` object that
             equals the current inference rule, ``False`` otherwise.
         """
+        if self is other:
+            # Часто сравниваются одни и те же объекты правил, например MP
+            return True
         return isinstance(other, InferenceRule) and \
+            hash(self) == hash(other) and \
             self.assumptions == other.assumptions and \
             self.conclusion == other.conclusion
 
@@ -80,8 +196,13 @@ class InferenceRule:
         return not self == other
 
     def __hash__(self) -> int:
-        return hash(str(self))
+        rule_hash = getattr(self, '_hash', None)
+        if rule_hash is None:
+            rule_hash = hash((self.assumptions, self.conclusion))
+            object.__setattr__(self, '_hash', rule_hash)
+        return rule_hash
 
+    @memoized_parameterless_method
     def variables(self) -> Set[str]:
         """Finds all variable names in the current inference rule.
 
@@ -90,9 +211,9 @@ class InferenceRule:
             conclusion of the current inference rule.
         """
         # Task 4.1
-        vars = self.conclusion.variables()
+        vars = set(self.conclusion.variables())
         for f in self.assumptions:
-            vars = vars | f.variables()
+            vars.update(f.variables())
         return vars
 
     def specialize(self, specialization_map: SpecializationMap) -> \
@@ -111,8 +232,9 @@ class InferenceRule:
         for variable in specialization_map:
             assert is_variable(variable)
         # Task 4.4
-        concl = self.conclusion.substitute_variables(specialization_map)
-        assums = [f.substitute_variables(specialization_map) for f in self.assumptions]
+        cache: Dict[int, Formula] = {}
+        concl = _substitute_variables_cached(self.conclusion, specialization_map, cache)
+        assums = [_substitute_variables_cached(f, specialization_map, cache) for f in self.assumptions]
         return InferenceRule(assums, concl)
 
     @staticmethod
@@ -142,19 +264,8 @@ class InferenceRule:
         # Task 4.5a
         if (specialization_map1 is None) or (specialization_map2 is None):
             return None
-        answer = True
-        sum = specialization_map2.copy()
-        for p in specialization_map1.keys():
-            if p in specialization_map2.keys():
-                if specialization_map1[p] != specialization_map2[p]:
-                    answer = False
-                    break
-            else:
-                sum[p] = specialization_map1[p]
-        if answer:
-            return sum
-        else:
-            return None
+        sum = dict(specialization_map2)
+        return sum if _merge_into(sum, specialization_map1) else None
 
     @staticmethod
     def _formula_specialization_map(general: Formula, specialization: Formula) \
@@ -171,27 +282,8 @@ class InferenceRule:
             in fact not a specialization of `general`.
         """
         # Task 4.5b
-        if is_constant(general.root):
-            if general == specialization:
-                return {}
-            else:
-                None
-        elif is_variable(general.root):
-            return {general.root: specialization}
-        elif is_unary(general.root):
-            if general.root == specialization.root:
-                return InferenceRule._formula_specialization_map(general.first, specialization.first)
-            else:
-                return None
-        elif is_binary(general.root):
-            if general.root == specialization.root:
-                sm1 = InferenceRule._formula_specialization_map(general.first, specialization.first)
-                sm2 = InferenceRule._formula_specialization_map(general.second, specialization.second)
-                return InferenceRule._merge_specialization_maps(sm1, sm2)
-            else:
-                return None
-        else:
-            return None
+        sm: Dict[str, Formula] = {}
+        return sm if _extend_specialization_map(general, specialization, sm, set()) else None
 
     def specialization_map(self, specialization: InferenceRule) -> \
             Union[SpecializationMap, None]:
@@ -206,16 +298,15 @@ class InferenceRule:
             in fact not a specialization of the current rule.
         """
         # Task 4.5c
-        sm = InferenceRule._formula_specialization_map(self.conclusion, specialization.conclusion)
-        # if sm is None:
-        #    return None
         if len(self.assumptions) != len(specialization.assumptions):
             return None
+        sm: Dict[str, Formula] = {}
+        visited: Set[Tuple[int, int]] = set()
+        if not _extend_specialization_map(self.conclusion, specialization.conclusion, sm, visited):
+            return None
         for i in range(len(self.assumptions)):
-            sm1 = InferenceRule._formula_specialization_map(self.assumptions[i], specialization.assumptions[i])
-            sm = InferenceRule._merge_specialization_maps(sm, sm1)
-            # if sm is None:
-            #    return None
+            if not _extend_specialization_map(self.assumptions[i], specialization.assumptions[i], sm, visited):
+                return None
         return sm
 
     def is_specialization_of(self, general: InferenceRule) -> bool:
@@ -263,6 +354,8 @@ class Proof:
         self.statement = statement
         self.rules = frozenset(rules)
         self.lines = tuple(lines)
+        # Множество гипотез для проверки строк-допущений в is_line_valid за O(1)
+        self._assumption_set = frozenset(statement.assumptions)
 
     @frozen
     class Line:
@@ -288,6 +381,9 @@ class Proof:
         rule: Optional[InferenceRule]
         assumptions: Optional[Tuple[int, ...]]
 
+        # Строк в доказательстве много, поэтому храним поля без `__dict__`
+        __slots__ = ('formula', 'rule', 'assumptions')
+
         def __init__(self, formula: Formula,
                      rule: Optional[InferenceRule] = None,
                      assumptions: Optional[Sequence[int]] = None):
@@ -312,6 +408,16 @@ class Proof:
             self.rule = rule
             self.assumptions = tuple(assumptions) if assumptions is not None else None
 
+        def __reduce__(self) -> Tuple[type, Tuple[Formula, Optional[InferenceRule], Optional[Tuple[int, ...]]]]:
+            """Specifies how to copy or pickle the current line.
+
+            Returns:
+                A pair of this class and the arguments with which it constructs
+                an equal line. The fields are passed to the constructor, since
+                the frozen slots of the line cannot be assigned after it.
+            """
+            return type(self), (self.formula, self.rule, self.assumptions)
+
         def __repr__(self) -> str:
             """Computes a string representation of the current line.
 
@@ -401,18 +507,26 @@ class Proof:
         """
         assert line_number < len(self.lines)
         # Task 4.6b
-        r = self.rule_for_line(line_number)
-        if r is None:  # Если строка получена не по правилу, то нужно проверить,
+        line = self.lines[line_number]
+        if line.is_assumption():  # Если строка получена не по правилу, то нужно проверить,
             # что формула содержится в гипотезах вывода
-            return self.lines[line_number].formula in self.statement.assumptions
-        else:
-            for i in self.lines[line_number].assumptions:
-                if i >= line_number:
-                    return False  # строка ссылается на строку с большим номером
-            if self.lines[line_number].rule in self.rules:
-                return r.is_specialization_of(self.lines[line_number].rule)
-            else:
-                return False  # Правила, по которому получена эта строка нет в допустимых правилах вывода
+            return line.formula in self._assumption_set
+        # Сначала дешевые проверки за O(1), затем проверка номеров строк
+        if line.rule not in self.rules:
+            return False  # Правила, по которому получена эта строка нет в допустимых правилах вывода
+        if len(line.rule.assumptions) != len(line.assumptions):
+            return False
+        if line.assumptions and max(line.assumptions) >= line_number:
+            return False  # строка ссылается на строку с большим номером
+        # Сопоставляем правило с самой строкой, не строя промежуточное правило
+        sm: Dict[str, Formula] = {}
+        visited: Set[Tuple[int, int]] = set()
+        if not _extend_specialization_map(line.rule.conclusion, line.formula, sm, visited):
+            return False
+        for assumption, i in zip(line.rule.assumptions, line.assumptions):
+            if not _extend_specialization_map(assumption, self.lines[i].formula, sm, visited):
+                return False
+        return True
 
     def is_valid(self) -> bool:
         """Checks if the current proof is a valid proof of its claimed statement
@@ -433,6 +547,26 @@ class Proof:
         # Проверяем, что доказали то что нужно
 
 
+def _specialize_lines(lines: Sequence[Proof.Line],
+                      specialization_map: SpecializationMap) -> List[Proof.Line]:
+    """Specializes the formulas of the given proof lines according to the given
+    specialization map.
+
+    Parameters:
+        lines: proof lines to specialize.
+        specialization_map: mapping defining the specialization to be performed.
+
+    Returns:
+        The given lines, in the same order, with the formula of each line
+        specialized according to the given map, and with the same rules and
+        assumptions.
+    """
+    cache: Dict[int, Formula] = {}
+    return [Proof.Line(_substitute_variables_cached(line.formula, specialization_map, cache),
+                       line.rule, line.assumptions)
+            for line in lines]
+
+
 def prove_specialization(proof: Proof, specialization: InferenceRule) -> Proof:
     """Converts the given proof of an inference rule to a proof of the given
     specialization of that inference rule.
@@ -450,11 +584,7 @@ def prove_specialization(proof: Proof, specialization: InferenceRule) -> Proof:
 
     # Task 5.1
     specialization_map = proof.statement.specialization_map(specialization)
-    new_lines = []
-    for line in proof.lines:
-        new_formula = line.formula.substitute_variables(specialization_map)
-        new_lines.append(Proof.Line(new_formula, line.rule, line.assumptions))
-    return Proof(specialization, proof.rules, new_lines)
+    return Proof(specialization, proof.rules, _specialize_lines(proof.lines, specialization_map))
 
 
 def _inline_proof_once(main_proof: Proof, line_number: int,
@@ -487,26 +617,33 @@ def _inline_proof_once(main_proof: Proof, line_number: int,
     assert lemma_proof.is_valid()
     # Task 5.2a
     main_line = main_proof.lines[line_number]
-    partial_proof = prove_specialization(lemma_proof, main_proof.rule_for_line(line_number))
+    specialization = main_proof.rule_for_line(line_number)
+    # Специализируем строки леммы без построения промежуточного доказательства
+    specialized_lines = _specialize_lines(lemma_proof.lines,
+                                          lemma_proof.statement.specialization_map(specialization))
 
     new_lines = list(main_proof.lines[:line_number])
     assumptions_count = 0
-    subs = {}
+    subs = [0] * len(specialized_lines)
+    # Индекс первого вхождения каждого допущения, как у `index`
+    assumption_index = {}
+    for index, assumption in enumerate(specialization.assumptions):
+        assumption_index.setdefault(assumption, index)
 
-    for i, line in enumerate(partial_proof.lines):
+    for i, line in enumerate(specialized_lines):
         if line.is_assumption():
-            index = partial_proof.statement.assumptions.index(line.formula)
-            subs[i] = main_line.assumptions[index]
+            subs[i] = main_line.assumptions[assumption_index[line.formula]]
             assumptions_count += 1
         else:
             new_assumptions = [subs[j] for j in line.assumptions]
             subs[i] = len(new_lines)
             new_lines.append(Proof.Line(line.formula, line.rule, new_assumptions))
 
-    offset = len(partial_proof.lines) - assumptions_count - 1
+    offset = len(specialized_lines) - assumptions_count - 1
 
-    for i, line in enumerate(main_proof.lines[line_number + 1:]):
-        if line.is_assumption():
+    for line in main_proof.lines[line_number + 1:]:
+        # Строки, ссылающиеся только на строки до заменяемой, не меняются
+        if line.is_assumption() or not line.assumptions or max(line.assumptions) < line_number:
             new_lines.append(line)
         else:
             new_assumptions = [j if j < line_number else j + offset for j in line.assumptions]
@@ -536,14 +673,45 @@ def inline_proof(main_proof: Proof, lemma_proof: Proof) -> Proof:
     assert main_proof.is_valid()
     assert lemma_proof.is_valid()
     # Task 5.2b
-    new_proof = main_proof
-    while True:
-        for i, line in enumerate(new_proof.lines):
-            if not line.is_assumption() and line.rule == lemma_proof.statement:
-                new_proof = _inline_proof_once(new_proof, i, lemma_proof)
-                break
+    # Один проход вперед: line_map сопоставляет каждому номеру строки main_proof
+    # номер строки нового доказательства, обосновывающей ту же формулу
+    lemma = lemma_proof.statement
+    # Позиции допущений леммы не зависят от специализации, поэтому для каждой
+    # строки-допущения доказательства леммы они находятся один раз (как `index`)
+    assumption_index = {}
+    for index, assumption in enumerate(lemma.assumptions):
+        assumption_index.setdefault(assumption, index)
+    lemma_assumption_positions = [assumption_index[lemma_line.formula] if lemma_line.is_assumption() else None
+                                  for lemma_line in lemma_proof.lines]
+    new_lines = []
+    line_map = []
+    for line in main_proof.lines:
+        if line.is_assumption():
+            line_map.append(len(new_lines))
+            new_lines.append(line)
+        elif line.rule != lemma:
+            line_map.append(len(new_lines))
+            new_assumptions = [line_map[j] for j in line.assumptions]
+            # Строка без сдвинутых ссылок (например, до первого применения
+            # леммы) переиспользуется как есть
+            if all(j == k for j, k in zip(line.assumptions, new_assumptions)):
+                new_lines.append(line)
+            else:
+                new_lines.append(Proof.Line(line.formula, line.rule, new_assumptions))
         else:
-            break
-
-    return Proof(new_proof.statement, new_proof.rules - {lemma_proof.statement}, new_proof.lines)
+            specialization = InferenceRule([main_proof.lines[j].formula for j in line.assumptions], line.formula)
+            specialization_map = lemma.specialization_map(specialization)
+            cache: Dict[int, Formula] = {}
+            lemma_line_map = []
+            for lemma_line, index in zip(lemma_proof.lines, lemma_assumption_positions):
+                if index is not None:
+                    lemma_line_map.append(line_map[line.assumptions[index]])
+                else:
+                    lemma_line_map.append(len(new_lines))
+                    new_lines.append(Proof.Line(
+                        _substitute_variables_cached(lemma_line.formula, specialization_map, cache),
+                        lemma_line.rule, [lemma_line_map[j] for j in lemma_line.assumptions]))
+            line_map.append(lemma_line_map[-1])
+
+    return Proof(main_proof.statement, (main_proof.rules | lemma_proof.rules) - {lemma}, new_lines)
 
@@ -73,7 +73,18 @@ class Formula:
         return not self == other
 
     def __hash__(self) -> int:
-        return hash(str(self))
+        # Structural, so that hashing does not render the string representation.
+        # Computed once per formula, and kept like memoized method values.
+        formula_hash = getattr(self, "_hash", None)
+        if formula_hash is None:
+            if is_variable(self.root) or is_constant(self.root):
+                formula_hash = hash(self.root)
+            elif is_unary(self.root):
+                formula_hash = hash((self.root, hash(self.first)))
+            else:
+                formula_hash = hash((self.root, hash(self.first), hash(self.second)))
+            object.__setattr__(self, "_hash", formula_hash)
+        return formula_hash
 
     @memoized_parameterless_method
     def variables(self) -> Set[str]:
@@ -37,6 +37,7 @@ def test_task5(debug=False):
 
 def test_task6(debug=False):
     test_rule_for_line(debug)
+    test_copy_line(debug)
     test_is_line_valid(debug)
     test_is_valid(debug)
 
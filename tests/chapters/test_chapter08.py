@@ -19,10 +19,13 @@ def test_task2(debug=False):
 
 def test_task3(debug=False):
     test_compile_term(debug)
+    test_compile_deep_term(debug)
+    test_compile_repeated_subterm(debug)
 
 
 def test_task4(debug=False):
     test_replace_functions_with_relations_in_formula(debug)
+    test_replace_functions_with_relations_in_formula_repeated_subterm(debug)
 
 
 def test_task5(debug=False):
@@ -149,6 +149,66 @@ def test_compile_term(debug=False):
         assert steps == [Formula.parse(e) for e in expected]
 
 
+def test_compile_deep_term(debug=False):
+    from src.predicates.functions import _compile_term
+
+    term = Term("x")
+    for _ in range(300):
+        term = Term("f", [term])
+    if debug:
+        print("Compiling a term nested 300 deep ...")
+    steps = _compile_term(term)
+    assert len(steps) == 300
+    previous = Term("x")
+    for step in steps:
+        variable, invocation = step.arguments
+        assert invocation == Term("f", [previous])
+        previous = variable
+
+
+def test_compile_repeated_subterm(debug=False):
+    from src.predicates.functions import _compile_term
+
+    term = Term.parse("f(g(x),g(x))")
+    if debug:
+        print("Compiling", term, "...")
+    steps = _compile_term(term)
+    if debug:
+        print("... got", steps)
+    assert len(steps) == 2
+    first_variable, first_invocation = steps[0].arguments
+    assert first_invocation == Term.parse("g(x)")
+    second_variable, second_invocation = steps[1].arguments
+    assert second_invocation == Term("f", [first_variable, first_variable])
+
+
+def test_replace_functions_with_relations_in_formula_repeated_subterm(debug=False):
+    formula = Formula.parse("R(g(x),g(x))")
+    if debug:
+        print("Replacing functions with relations in formula", formula, "...")
+    new_formula = replace_functions_with_relations_in_formula(formula)
+    if debug:
+        print("... got", new_formula)
+    assert new_formula.root == "E"
+    variable = Term(new_formula.variable)
+    assert new_formula.statement.first == Formula("G", [variable, Term("x")])
+    assert new_formula.statement.second == Formula("R", [variable, variable])
+
+    # Subterms are only shared within a single relation invocation or equality
+    formula = Formula.parse("(R(g(x))&Q(g(x)))")
+    if debug:
+        print("Replacing functions with relations in formula", formula, "...")
+    new_formula = replace_functions_with_relations_in_formula(formula)
+    if debug:
+        print("... got", new_formula)
+    assert new_formula.root == "&"
+    for conjunct, relation in [(new_formula.first, "R"), (new_formula.second, "Q")]:
+        assert conjunct.root == "E"
+        variable = Term(conjunct.variable)
+        assert conjunct.statement.first == Formula("G", [variable, Term("x")])
+        assert conjunct.statement.second == Formula(relation, [variable])
+
+
 def test_replace_functions_with_relations_in_formula(debug=False):
     for s, valid_model, invalid_model in [
         [
@@ -489,7 +549,10 @@ def test_all(debug=False):
     test_replace_functions_with_relations_in_model(debug)
     test_replace_relations_with_functions_in_model(debug)
     test_compile_term(debug)
+    test_compile_deep_term(debug)
+    test_compile_repeated_subterm(debug)
     test_replace_functions_with_relations_in_formula(debug)
+    test_replace_functions_with_relations_in_formula_repeated_subterm(debug)
     test_replace_functions_with_relations_in_formulas(debug)
     test_replace_equality_with_SAME_in_formulas(debug)
     test_add_SAME_as_equality_in_model(debug)
@@ -415,6 +415,23 @@ def test_rule_for_line(debug=False):
         assert proof.rule_for_line(i) == z[i][1]
 
 
+def test_copy_line(debug=False):
+    import copy
+
+    for line in [
+        Proof.Line(Formula.parse("(p->q)")),
+        Proof.Line(Formula.parse("q"), InferenceRule([Formula.parse("p"), Formula.parse("(p->q)")],
+                                                     Formula.parse("q")), [0, 1]),
+    ]:
+        if debug:
+            print("Testing copying of the proof line", line)
+        for duplicate in [copy.copy(line), copy.deepcopy(line)]:
+            assert duplicate is not line
+            assert str(duplicate.formula) == str(line.formula)
+            assert duplicate.rule == line.rule
+            assert duplicate.assumptions == line.assumptions
+
+
 def test_is_line_valid(debug=False):
     x1 = Formula.parse("x")
     x2 = Formula.parse("~~x")
@@ -959,6 +976,7 @@ def test_ex4(debug=False):
     test_formula_specialization_map(debug)
     test_specialization_map(debug)
     test_rule_for_line(debug)
+    test_copy_line(debug)
     test_is_line_valid(debug)
     test_is_valid(debug)
 